@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 
-import sys, os, contextlib, struct, json, time, traceback
+import sys, os, re, functools, hashlib, select, struct, json, time, traceback
 import requests
+from requests.adapters import HTTPAdapter
 import gps, gps.ubx
 from gps.misc import monotonic
 
@@ -14,6 +15,7 @@ Valid keys:
 - token: only used for an unregistered device
 - data, gnss, lat, lon, alt, pacc: used for requesting data from u-blox service
 - cache_duration: validity of already downloaded data, in hours (default: 3)
+- force: send data to the device even if it was already delivered (1/0, yes/no, true/false; default: 0)
 
 Examples:
 - registration:
@@ -27,6 +29,20 @@ Documentation:
 
 """
 
+# UBX-MGA-INI-POS_LLH payload: type=0x01, version=0x00, reserved, then lat, lon, alt, acc
+_MGA_POS_TEMPLATE = b"\x01\x00\x00\x00" + bytes(16)
+_MGA_POS_STRUCT = struct.Struct("<3iI")
+
+_CSV_RE = re.compile(r"\s*,\s*")
+
+GNSS_CHOICES = frozenset({"gps", "glo", "gal", "bds", "qzss"})
+
+# preallocated buffer for answers read from gpsd
+RX_BUFFER_SIZE = 65536
+
+HTTP_TIMEOUT = (5, 30) # connect, read (seconds)
+HTTP_DOWNLOAD_TIMEOUT = (5, 60)
+
 class Helpers:
     def here(fname):
         return os.path.join(os.path.abspath(os.path.dirname(__file__)), os.path.basename(fname))
@@ -38,12 +54,27 @@ class Helpers:
 
     def validate_list(values, available_choices):
         if values:
-            if type(values) == str:
-                values = [v.strip() for v in values.split(",")]
-            for v in values:
-                if not v in available_choices:
-                    raise ValueError(f"Unknown value '{v}'; valid choices are: {', '.join(available_choices)}")
-            return ",".join(values)
+            if not isinstance(values, str):
+                values = ",".join(values)
+            return Helpers._validate_list(values, frozenset(available_choices))
+
+    @functools.lru_cache(maxsize=32)
+    def _validate_list(values, available_choices):
+        values = _CSV_RE.split(values.strip())
+        for v in values:
+            if not v in available_choices:
+                raise ValueError(f"Unknown value '{v}'; valid choices are: {', '.join(sorted(available_choices))}")
+        return ",".join(values)
+
+    def validate_bool(value):
+        if value is None or isinstance(value, bool):
+            return bool(value)
+        value = str(value).strip().lower()
+        if value in ("1", "true", "yes", "on"):
+            return True
+        if value in ("", "0", "false", "no", "off"):
+            return False
+        raise ValueError(f"Invalid value '{value}'; not a boolean")
 
     def validate_number(value, min_value, max_value):
         if value is not None:
@@ -60,23 +91,55 @@ class UBlox(gps.ubx.ubx):
     def __init__(self, device=None):
         self.timestamp = 0
         self.verbosity = 0
+        self._rxbuf = bytearray(RX_BUFFER_SIZE)
+        self._rxview = memoryview(self._rxbuf)
+        self._expected = {} # (class, id) -> UBX header
         self.io_handle = gps.gps_io(write_requested=True, gpsd_device=device)
 
-    def decode_msg(self, data):
-        with contextlib.redirect_stdout(None): # suppress output
-            consumed = super().decode_msg(data)
-        return consumed, data[:consumed], data[consumed:]
+    def frame_msg(self, data, offset=0):
+        # frame the UBX packet at data[offset:] without decoding its payload
+        mv = memoryview(data)
+        consumed = 0
+        if len(mv) - offset >= 8 and mv[offset] == 0xb5 and mv[offset + 1] == 0x62:
+            length = 8 + struct.unpack_from("<H", mv, offset + 4)[0]
+            if offset + length <= len(mv):
+                consumed = length
+        return consumed, mv[offset:offset + consumed]
 
     def wait_for(self, m_cls, m_id, timeout=2):
-        expected = bytes([0xb5, 0x62, m_cls, m_id])
-        data = b''
-        start = monotonic()
-        while timeout > (monotonic() - start):
-            if 0 < self.io_handle.ser.waiting():
-                data += self.io_handle.ser.sock.recv(8192)
-            consumed, packet, data = self.decode_msg(data)
-            if packet[0:4] == expected:
-                return packet
+        expected = self._expected.get((m_cls, m_id))
+        if expected is None:
+            expected = self._expected[(m_cls, m_id)] = bytes((0xb5, 0x62, m_cls, m_id))
+        rxbuf, rxview = self._rxbuf, self._rxview
+        sock = self.io_handle.ser.sock
+        _select, _mono = select.select, monotonic
+        wpos = 0
+        start = _mono()
+        while True:
+            remaining = timeout - (_mono() - start)
+            if remaining <= 0:
+                break
+            r, _, _ = _select([sock], [], [], remaining)
+            if not r:
+                break
+            n = sock.recv_into(rxview[wpos:])
+            if not n:
+                break # connection closed
+            wpos += n
+            idx = rxbuf.find(expected, 0, wpos)
+            if idx < 0:
+                # keep a possibly incomplete sync word at the tail
+                idx = max(wpos - 3, 0)
+            elif idx + 6 <= wpos:
+                length = struct.unpack_from("<H", rxbuf, idx + 4)[0]
+                end = idx + 8 + length
+                if end <= wpos:
+                    return rxview[idx:end].tobytes()
+                if end - idx > len(rxbuf):
+                    break # answer does not fit in the receive buffer
+            if idx > 0:
+                rxbuf[:wpos - idx] = rxbuf[idx:wpos]
+                wpos -= idx
         return b''
 
     def fetch_answer(self, msg):
@@ -87,11 +150,16 @@ class UBlox(gps.ubx.ubx):
         return self.wait_for(m_cls, m_id)
 
     def send_data(self, data):
-        while len(data):
-            consumed, packet, data = self.decode_msg(data)
+        # one packet per write: gpsd limits the size of each device write
+        mv = memoryview(data)
+        offset = 0
+        while offset < len(mv):
+            consumed, packet = self.frame_msg(mv, offset)
             if 0 >= consumed:
                 break
-            self.gps_send_raw(packet)
+            self.gps_send_raw(packet.tobytes())
+            offset += consumed
+        return offset
 
     def get_ubx_sec_uniqid(self):
         return self.fetch_answer("SEC-UNIQID")
@@ -105,47 +173,108 @@ class UBlox(gps.ubx.ubx):
         lon = int(lon_deg * 10**7)
         alt = int(alt_m * 10**2)
         acc = int(pacc_km * 10 **6)
-        m_data = bytearray(20)
-        m_data[0] = 0x01
-        m_data[1] = 0x00
-        struct.pack_into("<3iI", m_data, 4, lat, lon, alt, acc)
+        m_data = bytearray(_MGA_POS_TEMPLATE)
+        _MGA_POS_STRUCT.pack_into(m_data, 4, lat, lon, alt, acc)
         return self.make_pkt(0x13, 0x40, m_data)
 
 
 class AssistNow:
     def __init__(self, device=None, cache_duration=3):
+        self.device = device
         self.ublox = UBlox(device)
         self.cache_duration=Helpers.validate_number(cache_duration, 0, 24)
         self.config_file = Helpers.here("assistnow.json")
         self.cache_file = Helpers.here("assistnow.cache")
+        self.stamp_file = Helpers.here("assistnow.cache.stamp")
         self.config = self.load_config()
+        self._allowed_data = self.parse_allowed_data()
         self.cache = self.load_cache()
+        self.session = requests.Session()
+        self.session.headers["Connection"] = "keep-alive"
+        self.session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4))
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        session = getattr(self, "session", None)
+        if session is not None:
+            session.close()
+            self.session = None
 
     def load_config(self):
         config = {}
         try:
-            config = json.load(open(self.config_file, "r"))
-        except:
+            with open(self.config_file, "rb") as f:
+                config = json.load(f)
+        except (OSError, ValueError):
             pass
         return config
 
+    def parse_allowed_data(self):
+        if "allowedData" not in self.config:
+            return frozenset()
+        return frozenset(_CSV_RE.split(self.config["allowedData"].strip()))
+
     def save_config(self):
         if self.config:
-            open(self.config_file, "w").write(json.dumps(self.config, indent=2))
+            with open(self.config_file, "w") as f:
+                json.dump(self.config, f, indent=2)
 
     def load_cache(self):
         cache = None
         try:
             s = os.stat(self.cache_file)
             if time.time() - s.st_mtime <= self.cache_duration*3600:
-                cache = open(self.cache_file, "rb").read()
-        except:
+                with open(self.cache_file, "rb") as f:
+                    cache = f.read(s.st_size)
+        except OSError:
             pass
         return cache
 
     def save_cache(self):
         if self.cache:
-            open(self.cache_file, "wb").write(self.cache)
+            # write to a temporary file, then atomically replace the cache
+            tmp_file = self.cache_file + ".tmp"
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                try:
+                    view = memoryview(self.cache)
+                    while view:
+                        view = view[os.write(fd, view):]
+                finally:
+                    os.close(fd)
+                os.replace(tmp_file, self.cache_file)
+            except OSError:
+                os.unlink(tmp_file)
+                raise
+
+    def load_stamp(self):
+        stamp = {}
+        try:
+            with open(self.stamp_file, "rb") as f:
+                stamp = json.load(f)
+        except (OSError, ValueError):
+            pass
+        return stamp
+
+    def save_stamp(self):
+        if self.cache:
+            stamp = {
+                "sha": hashlib.sha256(self.cache).hexdigest(),
+                "device": self.device,
+                "sent_at": time.time(),
+            }
+            with open(self.stamp_file, "w") as f:
+                json.dump(stamp, f, indent=2)
+
+    def is_delivered(self):
+        stamp = self.load_stamp()
+        if not self.cache or stamp.get("device") != self.device:
+            return False
+        if stamp.get("sha") != hashlib.sha256(self.cache).hexdigest():
+            return False
+        return time.time() - stamp.get("sent_at", 0) <= self.cache_duration*3600
 
     def is_registered(self):
         return "chipcode" in self.config
@@ -160,22 +289,23 @@ class AssistNow:
             raise Exception("Device did not answer")
         url = "https://api.thingstream.io/ztp/assistnow/credentials"
         data = {"token": token, "messages": {"UBX-SEC-UNIQID": sec_uniqid, "UBX-MON-VER": mon_ver}}
-        r = requests.post(url, json=data)
+        r = self.session.post(url, json=data, timeout=HTTP_TIMEOUT)
         if r.status_code != requests.codes.ok:
             r.raise_for_status()
         self.config = r.json()
+        self._allowed_data = self.parse_allowed_data()
         self.save_config()
 
     def update(self, **kwargs):
         if not self.is_registered():
             raise Exception("Device not registered.")
 
+        force = Helpers.validate_bool(kwargs.pop("force", None))
         if not kwargs:
             kwargs = self.config
-        allowed_data = [d.strip() for d in self.config["allowedData"].split(",")]
         params = {
-            "data": Helpers.validate_list(kwargs.get("data", None), allowed_data),
-            "gnss": Helpers.validate_list(kwargs.get("gnss", None), ["gps", "glo", "gal", "bds", "qzss"]),
+            "data": Helpers.validate_list(kwargs.get("data", None), self._allowed_data),
+            "gnss": Helpers.validate_list(kwargs.get("gnss", None), GNSS_CHOICES),
             "lat": Helpers.validate_number(kwargs.get("lat", None), -90, 90),
             "lon": Helpers.validate_number(kwargs.get("lon", None), -180, 180),
             "alt": Helpers.validate_number(kwargs.get("alt", None), -1000, 50000),
@@ -184,6 +314,8 @@ class AssistNow:
         if params["lat"] is not None and params["lon"] is not None:
             params["filteronpos"] = 1
 
+        # the cache already starts with the UBX-MGA-INI-POS_LLH packet for the saved
+        # position: it must be invalidated whenever lat, lon, alt or pacc change
         changed = False
         for k, v in params.items():
             if self.config.get(k, None) != v:
@@ -198,33 +330,41 @@ class AssistNow:
             url = self.config["serviceUrl"]
             params["chipcode"] = self.config["chipcode"]
             print(f"Fetching data from {url}")
-            r = requests.get(url, params=params)
-            if r.status_code != requests.codes.ok:
-                r.raise_for_status()
-            data = r.content
+            # the initial position (if any) goes at the head of the download buffer
+            data = bytearray()
             if params["lat"] is not None and params["lon"] is not None:
                 args = [params[k] for k in ["lat", "lon"]]
                 kwargs = {k: params[k] for k in ["alt", "pacc"] if params[k] is not None}
-                initial_position = self.ublox.ubx_mga_ini_pos_llh(*args, **kwargs)
-                data = initial_position + data
-            self.cache = data
+                data += self.ublox.ubx_mga_ini_pos_llh(*args, **kwargs)
+            with self.session.get(url, params=params, stream=True, timeout=HTTP_DOWNLOAD_TIMEOUT,
+                                  headers={"Accept-Encoding": "gzip, deflate"}) as r:
+                if r.status_code != requests.codes.ok:
+                    r.raise_for_status()
+                for chunk in r.iter_content(chunk_size=65536):
+                    data += chunk
+            self.cache = bytes(data)
             self.save_cache()
         else:
             print("Valid cache found")
 
-        self.ublox.send_data(self.cache)
-        print("Sent data to device")
+        if force or not self.is_delivered():
+            sent = self.ublox.send_data(self.cache)
+            if sent != len(self.cache):
+                raise Exception(f"Invalid UBX data: only {sent} of {len(self.cache)} bytes sent")
+            self.save_stamp()
+            print("Sent data to device")
+        else:
+            print("Data already delivered to device")
 
 if __name__ == "__main__":
 
     kwargs = {}
-    try:
-        for item in sys.argv[1:]:
-            k, v = item.split("=", 1)
-            kwargs[k] = v
-    except:
-        print(USAGE)
-        quit(1)
+    for item in sys.argv[1:]:
+        if not "=" in item:
+            print(USAGE)
+            quit(1)
+        k, v = item.split("=", 1)
+        kwargs[k] = v
 
     assistnow = AssistNow(
         device=kwargs.get("device", None),
@@ -238,16 +378,16 @@ if __name__ == "__main__":
             quit(1)
         try:
             assistnow.register(kwargs["token"])
-            print(f"Device now registered with chipcode {assistnow.config['chipcode']}")
-            quit(0)
-        except:
+        except Exception:
             print("Error during registration")
             traceback.print_exc()
             quit(1)
+        print(f"Device now registered with chipcode {assistnow.config['chipcode']}")
+        quit(0)
 
     try:
         assistnow.update(**kwargs)
-    except:
+    except Exception:
         print("Error during update")
         traceback.print_exc()
         quit(1)